@@ -0,0 +1,10 @@
+import multiprocessing
+import os
+
+# One Uvicorn worker per core; uvicorn[standard] brings in uvloop and httptools
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Workers size their Postgres pools from this (see PG_POOL_TOTAL in main.py)
+os.environ["WEB_CONCURRENCY"] = str(workers)
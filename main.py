@@ -1,86 +1,448 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Header
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from supabase import create_client, Client
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
+from typing import Annotated, Optional
+import asyncpg
+import httpx
 import os
 from dotenv import load_dotenv
 import json
-from groq import Groq
+import time
+import logging
+import uuid
+import hashlib
+import asyncio
+import sqlite3
+import threading
+import sqlite_vec
+import tiktoken
+from fastembed import TextEmbedding
+from cachetools import TTLCache
+from groq import AsyncGroq
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
         "http://localhost:3000", 
-        "http://127.0.0.1:3000",
-        "https://*.vercel.app",  # Allow all Vercel deployments
-        "https://vercel.app"
+        "http://127.0.0.1:3000"
     ],
+    allow_origin_regex=r"^https://[^/]+\.vercel\.app$",  # Allow all Vercel deployments
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization", "Idempotency-Key"],
 )
 
-# Supabase client
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# Supabase Postgres connection pool
+SUPABASE_PG_URL = os.getenv("SUPABASE_PG_URL")
+
+if not SUPABASE_PG_URL:
+    raise ValueError("SUPABASE_PG_URL must be set in environment variables")
+
+# Connection budget shared by all workers (gunicorn.conf.py exports
+# WEB_CONCURRENCY), so the total stays within Supavisor's client limit
+PG_POOL_TOTAL = int(os.getenv("PG_POOL_TOTAL", "20"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", max(2, PG_POOL_TOTAL // int(os.getenv("WEB_CONCURRENCY", "1")))))
+PG_POOL_MIN = min(int(os.getenv("PG_POOL_MIN", "1")), PG_POOL_MAX)
+
+pool: asyncpg.Pool = None
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase URL and KEY must be set in environment variables")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+async def init_connection(conn: asyncpg.Connection):
+    """
+    Decode json/jsonb columns to Python objects on every pooled connection.
+    """
+    for type_name in ("json", "jsonb"):
+        await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
 
 # Groq AI Setup
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-groq_client = None
-if GROQ_API_KEY:
-    groq_client = Groq(api_key=GROQ_API_KEY)
+groq_client: AsyncGroq = None
+http_client: httpx.AsyncClient = None
+
+# Exact-match response cache, checked before the semantic cache
+exact_cache: TTLCache = None
+exact_cache_lock: asyncio.Lock = None
+
+# (request body hash, response future) by client-supplied Idempotency-Key,
+# so retries skip Groq and the insert
+idempotency_cache: TTLCache = None
+IDEMPOTENCY_WAIT = 120  # seconds a retry waits for the original request
+
+
+def prompt_key(prompt: str) -> bytes:
+    """
+    Hash a prompt into a compact exact-cache key.
+    """
+    return hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+
+
+# Semantic response cache (SQLite + sqlite-vec)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "ai_cache.db")
+SEMANTIC_CACHE_THRESHOLD = 0.92  # minimum cosine similarity for a hit
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # seconds
+SEMANTIC_CACHE_MAX_TOKENS = 256  # MiniLM truncates longer input, so it can't tell such texts apart
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+_cache_lock = threading.Lock()
+_cache_db = None
+_embedder = None
+
+
+def _semantic_cache():
+    """
+    Open the cache database and load the embedding model on first use.
+    """
+    global _cache_db, _embedder
+    with _cache_lock:
+        if _cache_db is None:
+            db = sqlite3.connect(SEMANTIC_CACHE_PATH, check_same_thread=False)
+            db.enable_load_extension(True)
+            sqlite_vec.load(db)
+            db.enable_load_extension(False)
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ai_cache (
+                    id INTEGER PRIMARY KEY,
+                    namespace TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    response TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            _embedder = TextEmbedding(EMBEDDING_MODEL)
+            _cache_db = db
+    return _cache_db, _embedder
+
+
+def semantic_lookup(text: str, namespace: str):
+    """
+    Embed the text and return (embedding, cached response or None).
+    """
+    db, embedder = _semantic_cache()
+    embedding = sqlite_vec.serialize_float32(next(iter(embedder.embed([text]))).tolist())
+
+    with _cache_lock:
+        row = db.execute(
+            "SELECT response, vec_distance_cosine(embedding, ?) AS d FROM ai_cache "
+            "WHERE namespace = ? AND expires_at > ? ORDER BY d LIMIT 1",
+            (embedding, namespace, time.time()),
+        ).fetchone()
+
+    if row and 1 - row[1] > SEMANTIC_CACHE_THRESHOLD:
+        return embedding, json.loads(row[0])
+    return embedding, None
+
+
+def semantic_store(embedding: bytes, namespace: str, response: dict):
+    """
+    Save a response under its text embedding and drop expired rows.
+    """
+    db, _ = _semantic_cache()
+    now = time.time()
+
+    with _cache_lock:
+        db.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (now,))
+        db.execute(
+            "INSERT INTO ai_cache (namespace, embedding, response, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, embedding, json.dumps(response), now + SEMANTIC_CACHE_TTL),
+        )
+        db.commit()
+
+
+# Batched database writes
+class AsyncBatcher:
+    """
+    Collect items submitted by concurrent requests and flush them together.
+
+    A batch is flushed once it reaches max_batch_size or max_wait_ms after its
+    first item arrived. flush receives the list of items and must return one
+    result per item, in order; an exception in place of a result is raised
+    to that item's submitter only.
+    """
+
+    def __init__(self, flush, max_batch_size: int = 50, max_wait_ms: int = 25):
+        self.flush = flush
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._spawn(self._run(self._take()))
+        elif self._timer is None:
+            self._timer = self._spawn(self._run_later())
+
+        return await future
+
+    def _spawn(self, coro):
+        # Keep a reference so in-flight flushes aren't garbage collected
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _take(self):
+        batch = self._pending[:self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size:]
+        return batch
+
+    async def _run_later(self):
+        await asyncio.sleep(self.max_wait)
+        self._timer = None
+        while self._pending:
+            await self._run(self._take())
+
+    async def _run(self, batch):
+        if not batch:
+            return
+
+        try:
+            results = await self.flush([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+# Row ids are generated by the API, so both tables need a uuid id column
+# (see migrations/000_create_tables.sql)
+# A repeated Idempotency-Key (e.g. a retry handled by another worker) is
+# skipped by the unique index from migrations/002_idempotency_keys.sql
+INSERT_TRANSCRIPTS = """
+    INSERT INTO transcripts (id, company_name, attendees, date, transcript, analysis, idempotency_key)
+    SELECT * FROM unnest($1::uuid[], $2::text[], $3::text[], $4::text[], $5::text[], $6::jsonb[], $7::text[])
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING id
+"""
+
+INSERT_ICEBREAKERS = """
+    INSERT INTO icebreakers (id, username, role, linkedin_bio, deck_url, analysis, idempotency_key)
+    SELECT * FROM unnest($1::uuid[], $2::text[], $3::text[], $4::text[], $5::text[], $6::jsonb[], $7::text[])
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING id
+"""
+
+
+def insert_rows(query: str, columns: tuple):
+    """
+    Build a flush function that inserts a batch of rows with one query.
+    """
+    async def flush(rows: list) -> list:
+        # One array parameter per column, unnested back into rows by Postgres
+        records = await pool.fetch(query, *[[row[column] for row in rows] for column in columns])
+
+        # Rows skipped as duplicates aren't returned; they resolve to None
+        inserted = {record["id"] for record in records}
+        return [row["id"] if row["id"] in inserted else None for row in rows]
+
+    return flush
+
+
+transcripts_batcher = AsyncBatcher(
+    insert_rows(INSERT_TRANSCRIPTS, ("id", "company_name", "attendees", "date", "transcript", "analysis", "idempotency_key")),
+    max_batch_size=50,
+    max_wait_ms=25,
+)
+icebreakers_batcher = AsyncBatcher(
+    insert_rows(INSERT_ICEBREAKERS, ("id", "username", "role", "linkedin_bio", "deck_url", "analysis", "idempotency_key")),
+    max_batch_size=50,
+    max_wait_ms=25,
+)
+
+
+async def complete_batch(requests: list) -> list:
+    """
+    Send a batch of chat completion requests concurrently over the shared Groq client.
+    """
+    return await asyncio.gather(
+        *[groq_client.chat.completions.create(**request) for request in requests],
+        return_exceptions=True,
+    )
+
+
+# Coalesces bursts of Groq calls so they go out together on warm connections
+groq_batcher = AsyncBatcher(complete_batch, max_batch_size=8, max_wait_ms=20)
+
+
+# Per-worker setup: each worker process builds its own clients, pool and caches
+@app.on_event("startup")
+async def startup():
+    global pool, http_client, groq_client, exact_cache, exact_cache_lock, idempotency_cache
+    pool = await asyncpg.create_pool(
+        SUPABASE_PG_URL,
+        min_size=PG_POOL_MIN,
+        max_size=PG_POOL_MAX,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=0,  # Supavisor (transaction mode) can't reuse prepared statements
+        init=init_connection,
+    )
+
+    # One keep-alive HTTP/2 client so Groq calls multiplex over warm connections
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+    if GROQ_API_KEY:
+        groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client)
+
+    exact_cache = TTLCache(maxsize=1024, ttl=3600)
+    exact_cache_lock = asyncio.Lock()
+    idempotency_cache = TTLCache(maxsize=1024, ttl=600)
+
+    # Load the embedding model now instead of on the first request
+    try:
+        await asyncio.to_thread(_semantic_cache)
+    except Exception:
+        logger.warning("Semantic cache unavailable at startup", exc_info=True)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
+    await pool.close()
 
 
 # Pydantic models
+# Every field is bounded so oversize payloads are rejected at validation,
+# before any AI call (username and role are repeated in the icebreaker prompt)
+ShortText = Annotated[str, StringConstraints(max_length=200)]
+MediumText = Annotated[str, StringConstraints(max_length=2048)]
+LongText = Annotated[str, StringConstraints(max_length=65536)]
+
+
 class TranscriptRequest(BaseModel):
-    transcript: str
-    company_name: str = ""
-    attendees: str = ""
-    date: str = ""
+    model_config = ConfigDict(extra="forbid")
+
+    transcript: LongText
+    company_name: ShortText = Field(default="")
+    attendees: MediumText = Field(default="")
+    date: ShortText = Field(default="")
 
 
 class IcebreakerRequest(BaseModel):
-    username: str
-    role: str
-    linkedin_bio: str
-    deck_url: str = ""
+    model_config = ConfigDict(extra="forbid")
+
+    username: ShortText
+    role: ShortText
+    linkedin_bio: LongText
+    deck_url: MediumText = Field(default="")
+
+
+# AI Helper functions using Groq
+GROQ_MODEL = "llama-3.1-8b-instant"  # Current Groq model
+TRANSCRIPT_MAX_INPUT_TOKENS = 6000
+
+# Approximate token counter for trimming input; safe to share across requests
+encoder = tiktoken.get_encoding("cl100k_base")
 
+AI_NOT_CONFIGURED = {
+    "summary": "Error: GROQ_API_KEY not configured. Please set your Groq API key in the .env file.",
+    "insights": ["AI configuration needed"],
+    "status": "error"
+}
 
-# AI Helper function using Groq
-async def call_ai(prompt: str) -> dict:
+
+def cache_namespace(endpoint: str, *identity: str) -> str:
+    """
+    Build a semantic-cache namespace that identity fields must match exactly.
+    """
+    return json.dumps([endpoint, *identity])
+
+
+async def lookup_cached(prompt: str, namespace: str, cache_text: str):
     """
-    Call Groq AI to generate response.
+    Check the exact and semantic caches; returns (key, embedding, cached response or None).
+
+    The semantic cache embeds only cache_text, the user's free text. Names
+    and roles are part of the namespace instead, since a few differing tokens
+    in an embedding would still let an answer about one person match another.
+    """
+    # Byte-identical prompts (retries, double submits) skip embedding entirely
+    key = prompt_key(prompt)
+    async with exact_cache_lock:
+        cached = exact_cache.get(key)
+    if cached is not None:
+        return key, None, cached
+
+    # Return a stored answer if near-identical input was seen before.
+    # Cache errors (e.g. a locked database) are treated as a miss.
+    try:
+        # Too long to embed faithfully; only the exact cache applies
+        if len(encoder.encode_ordinary(cache_text)) > SEMANTIC_CACHE_MAX_TOKENS:
+            return key, None, None
+
+        embedding, cached = await asyncio.to_thread(semantic_lookup, cache_text, namespace)
+    except Exception:
+        logger.warning("Semantic cache lookup failed", exc_info=True)
+        return key, None, None
+    if cached is not None:
+        async with exact_cache_lock:
+            exact_cache[key] = cached
+    return key, embedding, cached
+
+
+async def remember(key: bytes, embedding: Optional[bytes], namespace: str, result: dict):
+    """
+    Store a successful response in both caches; a failed store is only logged.
+    """
+    async with exact_cache_lock:
+        exact_cache[key] = result
+    if embedding is None:
+        return
+    try:
+        await asyncio.to_thread(semantic_store, embedding, namespace, result)
+    except Exception:
+        logger.warning("Semantic cache store failed", exc_info=True)
+
+
+async def call_ai(prompt: str, namespace: str, cache_text: str, max_tokens: int = 1000) -> dict:
+    """
+    Call Groq AI to generate response, reusing cached answers for similar prompts.
     """
     if not GROQ_API_KEY or not groq_client:
-        return {
-            "summary": "Error: GROQ_API_KEY not configured. Please set your Groq API key in the .env file.",
-            "insights": ["AI configuration needed"],
-            "status": "error"
-        }
+        return AI_NOT_CONFIGURED
+
+    key, embedding, cached = await lookup_cached(prompt, namespace, cache_text)
+    if cached is not None:
+        return cached
     
     try:
-        # Call Groq API using llama model
-        response = groq_client.chat.completions.create(
+        # Call Groq API using llama model, batched with concurrent calls
+        response = await groq_batcher.submit(dict(
             messages=[
                 {
                     "role": "user",
                     "content": prompt
                 }
             ],
-            model="llama-3.1-8b-instant",  # Current Groq model
+            model=GROQ_MODEL,
             temperature=0.7,
-            max_tokens=1000
-        )
+            max_tokens=max_tokens
+        ))
         
         # Extract text from response
         ai_text = response.choices[0].message.content
@@ -92,8 +454,6 @@ async def call_ai(prompt: str) -> dict:
             "status": "success"
         }
         
-        return result
-        
     except Exception as e:
         return {
             "summary": f"Error calling Groq API: {str(e)}",
@@ -101,6 +461,231 @@ async def call_ai(prompt: str) -> dict:
             "status": "error"
         }
 
+    # Only successful answers are worth reusing
+    await remember(key, embedding, namespace, result)
+
+    return result
+
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+async def stream_ai(prompt: str, namespace: str, cache_text: str, outcome: dict, row_id: str, max_tokens: int = 1000):
+    """
+    Stream a Groq response as Server-Sent Events.
+
+    Yields {"delta": ...} events as tokens arrive, then a final
+    {"result": ..., "id": ...} event with the assembled response. The result
+    is also put in outcome so it can be persisted once the stream has finished.
+    """
+    if not GROQ_API_KEY or not groq_client:
+        result = AI_NOT_CONFIGURED
+    else:
+        key, embedding, result = await lookup_cached(prompt, namespace, cache_text)
+        if result is not None:
+            yield sse_event({"delta": result["summary"]})
+        else:
+            parts = []
+            try:
+                stream = await groq_client.chat.completions.create(
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    model=GROQ_MODEL,
+                    temperature=0.7,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event({"delta": delta})
+
+                result = {
+                    "summary": "".join(parts),
+                    "insights": [],
+                    "status": "success"
+                }
+
+            except Exception as e:
+                result = {
+                    "summary": f"Error calling Groq API: {str(e)}",
+                    "insights": [],
+                    "status": "error"
+                }
+
+            if result["status"] == "success":
+                await remember(key, embedding, namespace, result)
+
+    outcome["result"] = result
+    yield sse_event({"result": result, "id": row_id})
+
+
+def wants_stream(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+def event_stream(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def save_row(batcher: AsyncBatcher, row: dict):
+    """
+    Insert a row from a background task, logging failures.
+
+    The client already has the row id by now, so a failed write can only be
+    surfaced in the logs.
+    """
+    try:
+        await batcher.submit(row)
+    except Exception:
+        logger.exception("Failed to save row %s", row["id"])
+
+
+async def save_streamed(batcher: AsyncBatcher, row: dict, outcome: dict):
+    """
+    Persist a streamed response after the stream has finished.
+    """
+    # Nothing to save if the client disconnected before the result was assembled
+    if "result" in outcome:
+        await save_row(batcher, {**row, "analysis": outcome["result"]})
+
+
+def claim_idempotency(namespace: str, idempotency_key: Optional[str], data: BaseModel):
+    """
+    Register a request under its Idempotency-Key; returns (future, owner).
+
+    The first request for a key gets a new future it must settle; later ones
+    get the same future to await. A key reused with a different body is
+    rejected.
+    """
+    if not idempotency_key:
+        return None, True
+
+    body_hash = hashlib.blake2b(data.model_dump_json().encode(), digest_size=16).digest()
+
+    # No await between the lookup and the insert, so two concurrent requests can't both claim a key
+    entry = idempotency_cache.get((namespace, idempotency_key))
+    if entry is None:
+        future = asyncio.get_running_loop().create_future()
+        idempotency_cache[(namespace, idempotency_key)] = (body_hash, future)
+        return future, True
+
+    if entry[0] != body_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+    return entry[1], False
+
+
+async def await_original(future: asyncio.Future) -> dict:
+    """
+    Wait for the request that owns the Idempotency-Key and return its response.
+    """
+    try:
+        body = await asyncio.wait_for(asyncio.shield(future), IDEMPOTENCY_WAIT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+    if body is None:
+        raise HTTPException(status_code=409, detail="The original request with this Idempotency-Key failed; retry it")
+    return body
+
+
+def settle_idempotency(namespace: str, idempotency_key: Optional[str], future: Optional[asyncio.Future], body: Optional[dict]):
+    """
+    Resolve an owned key: successful responses are kept for replay, anything
+    else releases the key so the client can retry.
+    """
+    if future is None or future.done():
+        return
+
+    if body is None or body["result"]["status"] != "success":
+        idempotency_cache.pop((namespace, idempotency_key), None)
+        body = None
+    future.set_result(body)
+
+
+async def settle_after_stream(events, namespace: str, idempotency_key: Optional[str], future, outcome: dict, row_id: str):
+    """
+    Pass SSE events through and settle the Idempotency-Key when the stream ends or is dropped.
+    """
+    try:
+        async for event in events:
+            yield event
+    finally:
+        result = outcome.get("result")
+        settle_idempotency(namespace, idempotency_key, future, {"result": result, "id": row_id} if result else None)
+
+
+async def replay(body: dict):
+    yield sse_event(body)
+
+
+# Prompt templates, filled with str.format_map per request
+TRANSCRIPT_TEMPLATE = """
+Review this transcript for {company_name}.
+Attendees: {attendees}
+Date: {date}
+
+Transcript:
+{transcript}
+
+Share:
+1. What I did well (and why)
+2. What I could do better next time
+3. Recommendations for improvement
+"""
+
+ICEBREAKER_TEMPLATE = """
+You are a sales expert analyzing a LinkedIn prospect for personalized outreach. Here's the prospect information:
+
+**Prospect Name:** {username}
+**Current Role:** {role}
+
+**LinkedIn About Section:**
+{linkedin_bio}
+
+**Pitch Deck Context:** {deck_context}
+
+Based on this information, provide a comprehensive icebreaker analysis with the following sections:
+
+## 1. BUYING SIGNALS
+- Identify 3-5 specific indicators that suggest {username} might be interested in purchasing solutions
+- Look for pain points, growth initiatives, technology mentions, or business challenges
+- Reference their role as {role} and how it relates to potential needs
+
+## 2. DISCOVERY TRIGGERS
+- Find 3-4 conversation starters based on their background
+- Identify shared connections, interests, or experiences
+- Highlight recent achievements or career moves worth mentioning
+
+## 3. SMART QUESTIONS
+- Create 4-5 thoughtful, role-specific questions for {role}
+- Questions should demonstrate industry knowledge and genuine interest
+- Avoid generic questions - make them specific to their situation
+
+## 4. PERSONALIZED OUTREACH APPROACH
+- Suggest the best way to approach {username} based on their communication style
+- Recommend timing and channel preferences
+- Identify what value proposition would resonate most
+
+## 5. REFLECTION QUESTIONS
+- What are the top 3 things {username} would likely care about most?
+- What's unclear about their current situation that needs discovery?
+- What potential objections might they have and how to address them?
+
+Make the analysis specific to {username} as a {role} and avoid generic advice.
+"""
+
 
 @app.get("/")
 async def health():
@@ -108,109 +693,191 @@ async def health():
 
 
 @app.post("/analyze_transcript")
-async def analyze_transcript(data: TranscriptRequest):
+async def analyze_transcript(
+    data: TranscriptRequest,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None)
+):
     """
     Analyze a transcript and provide insights.
+
+    The row id is generated here and the insert runs as a background task,
+    so the response doesn't wait on the database. Clients sending
+    Accept: text/event-stream get the analysis streamed as Server-Sent Events.
+    Retries carrying the same Idempotency-Key within 10 minutes get the
+    original response back when they reach the same worker, waiting for it
+    if it is still being generated; reusing a key with a different body is
+    rejected with 422. Across workers the key still prevents a second row.
     """
+    claimed = None
     try:
-        # Create prompt
-        prompt = f"""
-        Review this transcript for {data.company_name}.
-        Attendees: {data.attendees}
-        Date: {data.date}
+        # Retries of a known Idempotency-Key get the original response, waiting for it if needed
+        future, owner = claim_idempotency("transcript", idempotency_key, data)
+        if not owner:
+            previous = await await_original(future)
+            return event_stream(replay(previous)) if wants_stream(request) else previous
+        claimed = future
+
+        # Keep only the most recent part of very long transcripts
+        tokens = encoder.encode_ordinary(data.transcript)
+        transcript = data.transcript
+        if len(tokens) > TRANSCRIPT_MAX_INPUT_TOKENS:
+            transcript = encoder.decode(tokens[-TRANSCRIPT_MAX_INPUT_TOKENS:])
+
+        # Short transcripts need a shorter review
+        max_tokens = min(1000, 400 + len(tokens) // 4)
 
-        Transcript:
-        {data.transcript}
-
-        Share:
-        1. What I did well (and why)
-        2. What I could do better next time
-        3. Recommendations for improvement
-        """
-
-        # Call AI
-        ai_response = await call_ai(prompt)
+        # Create prompt
+        prompt = TRANSCRIPT_TEMPLATE.format_map({
+            "company_name": data.company_name,
+            "attendees": data.attendees,
+            "date": data.date,
+            "transcript": transcript
+        })
+        namespace = cache_namespace("transcript", data.company_name, data.attendees, data.date)
 
-        # Save to Supabase
-        result = supabase.table("transcripts").insert({
+        row_id = uuid.uuid4()
+        row = {
+            "id": row_id,
             "company_name": data.company_name,
             "attendees": data.attendees,
             "date": data.date,
             "transcript": data.transcript,
-            "analysis": ai_response
-        }).execute()
+            "idempotency_key": idempotency_key
+        }
+
+        if wants_stream(request):
+            outcome = {}
+            background_tasks.add_task(save_streamed, transcripts_batcher, row, outcome)
+            events = stream_ai(prompt, namespace, transcript, outcome, str(row_id), max_tokens)
+            events = settle_after_stream(events, "transcript", idempotency_key, claimed, outcome, str(row_id))
+            claimed = None  # the stream settles the key from here on
+            return event_stream(events)
 
-        return {"result": ai_response, "id": result.data[0]["id"] if result.data else None}
+        # Call AI
+        ai_response = await call_ai(prompt, namespace, transcript, max_tokens)
+
+        # Save to Postgres after responding (batched with concurrent submissions)
+        background_tasks.add_task(save_row, transcripts_batcher, {**row, "analysis": ai_response})
+
+        body = {"result": ai_response, "id": str(row_id)}
+        settle_idempotency("transcript", idempotency_key, claimed, body)
+
+        return body
+
+    except HTTPException:
+        raise
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    finally:
+        # Release the key unless it was settled above, including on cancellation
+        settle_idempotency("transcript", idempotency_key, claimed, None)
+
 
 @app.post("/generate_icebreaker")
-async def generate_icebreaker(data: IcebreakerRequest):
+async def generate_icebreaker(
+    data: IcebreakerRequest,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None)
+):
     """
     Generate LinkedIn icebreaker based on profile information and deck.
+
+    Supports Accept: text/event-stream and Idempotency-Key like /analyze_transcript.
     """
+    claimed = None
     try:
-        # Create enhanced prompt
-        prompt = f"""
-        You are a sales expert analyzing a LinkedIn prospect for personalized outreach. Here's the prospect information:
-
-        **Prospect Name:** {data.username}
-        **Current Role:** {data.role}
-        
-        **LinkedIn About Section:**
-        {data.linkedin_bio}
-
-        **Pitch Deck Context:** {data.deck_url if data.deck_url else "No pitch deck provided"}
-
-        Based on this information, provide a comprehensive icebreaker analysis with the following sections:
+        # Retries of a known Idempotency-Key get the original response, waiting for it if needed
+        future, owner = claim_idempotency("icebreaker", idempotency_key, data)
+        if not owner:
+            previous = await await_original(future)
+            return event_stream(replay(previous)) if wants_stream(request) else previous
+        claimed = future
 
-        ## 1. BUYING SIGNALS
-        - Identify 3-5 specific indicators that suggest {data.username} might be interested in purchasing solutions
-        - Look for pain points, growth initiatives, technology mentions, or business challenges
-        - Reference their role as {data.role} and how it relates to potential needs
-
-        ## 2. DISCOVERY TRIGGERS
-        - Find 3-4 conversation starters based on their background
-        - Identify shared connections, interests, or experiences
-        - Highlight recent achievements or career moves worth mentioning
+        # Create enhanced prompt
+        prompt = ICEBREAKER_TEMPLATE.format_map({
+            "username": data.username,
+            "role": data.role,
+            "linkedin_bio": data.linkedin_bio,
+            "deck_context": data.deck_url if data.deck_url else "No pitch deck provided"
+        })
+        namespace = cache_namespace("icebreaker", data.username, data.role, data.deck_url)
 
-        ## 3. SMART QUESTIONS
-        - Create 4-5 thoughtful, role-specific questions for {data.role}
-        - Questions should demonstrate industry knowledge and genuine interest
-        - Avoid generic questions - make them specific to their situation
+        row_id = uuid.uuid4()
+        row = {
+            "id": row_id,
+            "username": data.username,
+            "role": data.role,
+            "linkedin_bio": data.linkedin_bio,
+            "deck_url": data.deck_url,
+            "idempotency_key": idempotency_key
+        }
 
-        ## 4. PERSONALIZED OUTREACH APPROACH
-        - Suggest the best way to approach {data.username} based on their communication style
-        - Recommend timing and channel preferences
-        - Identify what value proposition would resonate most
+        if wants_stream(request):
+            outcome = {}
+            background_tasks.add_task(save_streamed, icebreakers_batcher, row, outcome)
+            events = stream_ai(prompt, namespace, data.linkedin_bio, outcome, str(row_id))
+            events = settle_after_stream(events, "icebreaker", idempotency_key, claimed, outcome, str(row_id))
+            claimed = None  # the stream settles the key from here on
+            return event_stream(events)
 
-        ## 5. REFLECTION QUESTIONS
-        - What are the top 3 things {data.username} would likely care about most?
-        - What's unclear about their current situation that needs discovery?
-        - What potential objections might they have and how to address them?
+        # Call AI
+        ai_response = await call_ai(prompt, namespace, data.linkedin_bio)
 
-        Make the analysis specific to {data.username} as a {data.role} and avoid generic advice.
-        """
+        # Save to Postgres with new fields after responding (batched with concurrent submissions)
+        background_tasks.add_task(save_row, icebreakers_batcher, {**row, "analysis": ai_response})
 
-        # Call AI
-        ai_response = await call_ai(prompt)
+        body = {"result": ai_response, "id": str(row_id)}
+        settle_idempotency("icebreaker", idempotency_key, claimed, body)
 
-        # Save to Supabase with new fields
-        result = supabase.table("icebreakers").insert({
-            "username": data.username,
-            "role": data.role,
-            "linkedin_bio": data.linkedin_bio,
-            "deck_url": data.deck_url,
-            "analysis": ai_response
-        }).execute()
+        return body
 
-        return {"result": ai_response, "id": result.data[0]["id"] if result.data else None}
+    except HTTPException:
+        raise
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    finally:
+        # Release the key unless it was settled above, including on cancellation
+        settle_idempotency("icebreaker", idempotency_key, claimed, None)
+
+
+# Relies on the created_at indexes in migrations/001_feed_created_at_indexes.sql
+# so each branch is an index scan merged by the planner, not a full sort.
+# The whole response body is built in Postgres and returned as text, so
+# Python never parses or re-encodes the items.
+FEED_QUERY = """
+    SELECT json_build_object(
+               'items',
+               coalesce(
+                   json_agg(
+                       json_build_object(
+                           'id', id, 'type', type, 'title', title, 'description', description,
+                           'date', date, 'analysis', analysis, 'created_at', created_at
+                       )
+                       ORDER BY created_at DESC
+                   ),
+                   '[]'::json
+               )
+           )::text
+    FROM (
+        SELECT id, 'transcript' AS type, company_name AS title, attendees AS description,
+               date, analysis, created_at
+        FROM transcripts
+        UNION ALL
+        SELECT id, 'icebreaker', 'LinkedIn Icebreaker - ' || username, role || ' • Sales Outreach Analysis',
+               NULL, analysis, created_at
+        FROM icebreakers
+        ORDER BY created_at DESC
+        LIMIT 20
+    ) AS feed
+"""
+
 
 @app.get("/feed")
 async def get_feed():
@@ -218,43 +885,10 @@ async def get_feed():
     Get all transcripts and icebreakers for the feed.
     """
     try:
-        # Get transcripts
-        transcripts_data = supabase.table("transcripts").select("*").order("created_at", desc=True).limit(20).execute()
-        
-        # Get icebreakers
-        icebreakers_data = supabase.table("icebreakers").select("*").order("created_at", desc=True).limit(20).execute()
-        
-        feed_items = []
-        
-        # Format transcripts
-        for item in transcripts_data.data:
-            feed_items.append({
-                "id": item["id"],
-                "type": "transcript",
-                "title": item.get("company_name", "Unknown Company"),
-                "description": item.get("attendees", ""),
-                "date": item.get("date", ""),
-                "analysis": item.get("analysis", {}),
-                "created_at": item.get("created_at", "")
-            })
-        
-        # Format icebreakers
-        for item in icebreakers_data.data:
-            username = item.get("username", "Unknown User")
-            role = item.get("role", "Unknown Role")
-            feed_items.append({
-                "id": item["id"],
-                "type": "icebreaker",
-                "title": f"LinkedIn Icebreaker - {username}",
-                "description": f"{role} • Sales Outreach Analysis",
-                "analysis": item.get("analysis", {}),
-                "created_at": item.get("created_at", "")
-            })
-        
-        # Sort by created_at
-        feed_items.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        
-        return {"items": feed_items}
+        # Merge, sort, limit and serialize both tables in one query
+        body = await pool.fetchval(FEED_QUERY)
+
+        return Response(content=body, media_type="application/json")
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
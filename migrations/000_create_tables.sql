@@ -0,0 +1,23 @@
+-- Tables used by the API. Row ids are generated by the API (uuid4) and
+-- inserted explicitly, so id must be uuid; tables created earlier with an
+-- int8 identity id are left untouched here and must be migrated by hand.
+
+CREATE TABLE IF NOT EXISTS transcripts (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    company_name text,
+    attendees text,
+    date text,
+    transcript text,
+    analysis jsonb,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS icebreakers (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    username text,
+    role text,
+    linkedin_bio text,
+    deck_url text,
+    analysis jsonb,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
@@ -0,0 +1,6 @@
+-- Indexes backing GET /feed (ORDER BY created_at DESC LIMIT 20 over both tables).
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so apply
+-- this file directly, e.g. `psql "$SUPABASE_PG_URL" -f migrations/001_feed_created_at_indexes.sql`.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transcripts_created_at ON transcripts (created_at DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_icebreakers_created_at ON icebreakers (created_at DESC);
@@ -0,0 +1,11 @@
+-- Client-supplied Idempotency-Key per row. The unique indexes let inserts use
+-- ON CONFLICT (idempotency_key) DO NOTHING, so a retry handled by another
+-- worker can't add a second row. Rows without a key (NULL) never conflict.
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so apply
+-- this file directly, e.g. `psql "$SUPABASE_PG_URL" -f migrations/002_idempotency_keys.sql`.
+
+ALTER TABLE transcripts ADD COLUMN IF NOT EXISTS idempotency_key text;
+ALTER TABLE icebreakers ADD COLUMN IF NOT EXISTS idempotency_key text;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_transcripts_idempotency_key ON transcripts (idempotency_key);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_icebreakers_idempotency_key ON icebreakers (idempotency_key);